@@ -5,6 +5,7 @@ except ModuleNotFoundError:
     # We need to import it here to get some variables and the path to the installed package
     pass
 import atexit
+import json
 import logging
 import os
 import signal
@@ -194,6 +195,42 @@ parser.add_argument(
     help="Upload locust-plugins to load gens (useful if you are developing locust-plugins)",
 )
 parser.add_argument("--ssh-port", type=int, help="Port to use with SSH.")
+parser.add_argument(
+    "--preflight",
+    action="store_true",
+    default=False,
+    help="Check OS limits (open files, ephemeral ports, somaxconn, TIME_WAIT reuse, cpu governor) on all load gens before starting and print a report",
+)
+parser.add_argument(
+    "--nofile-limit",
+    type=int,
+    default=0,
+    help="Raise the open files limit (ulimit -n) for the worker processes to this value (must not exceed the load gen's hard limit). Defaults to 0, meaning leave it unchanged. With --remote-master the workers are started using sudo, which may reset the limit depending on the load gen's PAM configuration.",
+)
+parser.add_argument(
+    "--pin-cpus",
+    type=str,
+    choices=["core", "numa"],
+    help="Pin each worker process to a dedicated cpu core (core) or spread them over NUMA nodes (numa) on the load gens. Linux only, requires taskset.",
+)
+parser.add_argument(
+    "--reserve-browser-cores",
+    type=int,
+    default=0,
+    help="Number of physical cores on each load gen to reserve for the selenium server (worker processes will not be scheduled on them). Playwright browsers are started by the worker processes and share their cpus.",
+)
+parser.add_argument(
+    "--cpu-placement-file",
+    type=str,
+    help="Write the cpu placement of worker processes and browser servers to this file (json), for comparing between runs",
+)
+parser.add_argument(
+    "-u",
+    "--users",
+    type=int,
+    help="Passed on to locust master unchanged (swarm only reads it to size the --preflight checks)",
+    env_var="LOCUST_USERS",
+)
 
 parser.add_argument(
     "--version",
@@ -298,6 +335,230 @@ def cleanup(server_list):
     logging.debug("cleanup complete")
 
 
+# file descriptors each worker process needs on top of one per user (locustfile, logs, zmq sockets etc)
+NOFILE_HEADROOM = 100
+
+LIMITS_COMMAND = (
+    "echo nofile=$(ulimit -n); "
+    "echo nofile_hard=$(ulimit -Hn); "
+    "echo port_range=$(cat /proc/sys/net/ipv4/ip_local_port_range 2>/dev/null); "
+    "echo somaxconn=$(cat /proc/sys/net/core/somaxconn 2>/dev/null); "
+    "echo tcp_tw_reuse=$(cat /proc/sys/net/ipv4/tcp_tw_reuse 2>/dev/null); "
+    "echo governor=$(cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_governor 2>/dev/null)"
+)
+
+
+def get_output_multiple(commands_by_server, timeout=5):
+    # the timeout is shared between all servers and kept short, because this runs while
+    # the load gens are locked (the lock only lasts about 20 seconds)
+    running_procs = {}
+    for server, command in commands_by_server.items():
+        logging.debug(command)
+        running_procs[server] = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    outputs = {}
+    deadline = time.time() + timeout
+    try:
+        for server, process in running_procs.items():
+            try:
+                output, _ = process.communicate(timeout=max(deadline - time.time(), 0))
+            except subprocess.TimeoutExpired:
+                raise Exception(f"Timed out after {timeout} seconds waiting for loadgen {server}: {process.args}")
+            if process.returncode != 0:
+                raise Exception(f"Bad return code {process.returncode} from command: {process.args}")
+            outputs[server] = output.decode()
+    finally:
+        for process in running_procs.values():
+            if process.poll() is None:
+                process.kill()
+    return outputs
+
+
+def get_limits_multiple(server_list):
+    outputs = get_output_multiple({
+        server: f"ssh {' '.join(ssh_port_args)} -q {server} '{LIMITS_COMMAND}'" for server in server_list
+    })
+    return {
+        server: dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+        for server, output in outputs.items()
+    }
+
+
+def check_limits(limits):
+    problems = []
+    nofile = args.nofile_limit or (int(limits["nofile"]) if limits["nofile"].isdigit() else None)
+    # with --processes -1 (one per cpu) we dont know how many worker processes there will be
+    if args.users and nofile is not None and args.processes > 0:
+        needed = -(-args.users // (args.processes * args.loadgens)) + NOFILE_HEADROOM
+        if nofile < needed:
+            problems.append(f"open files limit {nofile} is below the ~{needed} needed per worker process")
+    port_range = limits["port_range"].split()
+    if args.users and len(port_range) == 2:
+        available_ports = int(port_range[1]) - int(port_range[0]) + 1
+        needed = -(-args.users // args.loadgens)
+        if available_ports < needed:
+            problems.append(
+                f"ephemeral port range has {available_ports} ports, fewer than the {needed} users per load gen"
+            )
+    if limits["tcp_tw_reuse"] == "0":
+        problems.append("net.ipv4.tcp_tw_reuse is disabled, connections in TIME_WAIT may exhaust ephemeral ports")
+    if limits["governor"] and limits["governor"] != "performance":
+        problems.append(f"cpu frequency governor is {limits['governor']} (performance is recommended)")
+    return problems
+
+
+def check_nofile_limit(all_limits):
+    for server, limits in all_limits.items():
+        if limits["nofile_hard"].isdigit() and args.nofile_limit > int(limits["nofile_hard"]):
+            parser.error(
+                f"--nofile-limit {args.nofile_limit} exceeds the open files hard limit on {server} ({limits['nofile_hard']})"
+            )
+
+
+def preflight(all_limits):
+    print(f"{'loadgen':<30} {'nofile':>15} {'port range':>13} {'somaxconn':>10} {'tw_reuse':>9} {'governor':>12}")
+    for server, limits in all_limits.items():
+        nofile = f"{limits['nofile']}/{limits['nofile_hard']}"
+        if args.nofile_limit:
+            nofile = f"{args.nofile_limit}/{limits['nofile_hard']}"
+        port_range = "-".join(limits["port_range"].split()) or "?"
+        print(
+            f"{server:<30} {nofile:>15} {port_range:>13} {limits['somaxconn'] or '?':>10} {limits['tcp_tw_reuse'] or '?':>9} {limits['governor'] or '?':>12}"
+        )
+    for server, limits in all_limits.items():
+        for problem in check_limits(limits):
+            logging.warning(f"{server}: {problem}")
+
+
+def format_cpu_list(cpus):
+    # [0, 1, 2, 3, 8] -> "0-3,8", the format used by taskset -c
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def parse_cpu_topology(lscpu_output):
+    # returns {(node, core): [cpu, ...]} from the output of lscpu -p=CPU,CORE,NODE
+    cores = OrderedDict()
+    for line in lscpu_output.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        cpu, core, node = (line.split(",") + ["", ""])[:3]
+        cores.setdefault((int(node or 0), int(core or cpu)), []).append(int(cpu))
+    return cores
+
+
+def plan_cpu_placement(cores):
+    core_keys = sorted(cores)
+    browser_keys = []
+    if args.reserve_browser_cores:
+        if args.reserve_browser_cores >= len(core_keys):
+            raise Exception(
+                f"Cannot reserve {args.reserve_browser_cores} cores for browsers, load gen only has {len(core_keys)}"
+            )
+        browser_keys = core_keys[-args.reserve_browser_cores :]
+        core_keys = core_keys[: -args.reserve_browser_cores]
+
+    if args.pin_cpus == "numa":
+        nodes = OrderedDict()
+        for node, core in core_keys:
+            nodes.setdefault(node, []).extend(cores[(node, core)])
+        candidates = list(nodes.values())
+    elif args.pin_cpus == "core":
+        # one logical cpu per physical core first, hyperthread siblings only if there are more processes than cores
+        max_threads = max(len(cores[key]) for key in core_keys)
+        candidates = [
+            [sorted(cores[key])[thread]]
+            for thread in range(max_threads)
+            for key in core_keys
+            if thread < len(cores[key])
+        ]
+    else:
+        candidates = []
+
+    return {
+        "workers": [candidates[i % len(candidates)] for i in range(args.processes)] if candidates else [],
+        "worker_cpus": [cpu for key in core_keys for cpu in cores[key]],
+        "browser_cpus": [cpu for key in browser_keys for cpu in cores[key]],
+    }
+
+
+def plan_cpu_placement_multiple(server_list):
+    outputs = get_output_multiple({
+        server: f"ssh {' '.join(ssh_port_args)} -q {server} 'lscpu -p=CPU,CORE,NODE'" for server in server_list
+    })
+    cpu_plans = {}
+    for server, output in outputs.items():
+        cpu_plans[server] = plan_cpu_placement(parse_cpu_topology(output))
+        if args.pin_cpus == "core" and len(set(map(tuple, cpu_plans[server]["workers"]))) < args.processes:
+            logging.warning(f"{server}: not enough cores for {args.processes} processes, some will share a cpu")
+    return cpu_plans
+
+
+def find_worker_pids(ps_output):
+    procs = {}
+    for line in ps_output.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) == 3 and "locust --worker" in fields[2]:
+            procs[int(fields[0])] = int(fields[1])
+    # the remote shell and the --processes parent also match, so only keep the innermost processes
+    return sorted(pid for pid in procs if pid not in procs.values())
+
+
+def pin_worker_processes(cpu_plans, worker_procs):
+    # worker processes are forked by locust after it has started, so we need to wait for them to appear.
+    # poll often, because the test starts as soon as they have connected to master
+    sudo = "sudo " if args.remote_master else ""
+    placement = {}
+    pending = [server for server, plan in cpu_plans.items() if plan["workers"]]
+    deadline = time.time() + 30
+    while pending:
+        for proc in worker_procs:
+            check_proc_running(proc)
+        outputs = get_output_multiple({
+            server: f"ssh {' '.join(ssh_port_args)} -q {server} 'ps -e -o pid=,ppid=,args='" for server in pending
+        })
+        pin_commands = []
+        for server, output in outputs.items():
+            pids = find_worker_pids(output)
+            if len(pids) < args.processes:
+                continue
+            # listed by index rather than pid, so that placement files from different runs can be diffed
+            placement[server] = [
+                {"pid": pid, "cpus": format_cpu_list(cpus)} for pid, cpus in zip(pids, cpu_plans[server]["workers"])
+            ]
+            taskset_commands = [
+                f"{sudo}taskset -a -pc {worker['cpus']} {worker['pid']} > /dev/null" for worker in placement[server]
+            ]
+            pin_commands.append(f"ssh {' '.join(ssh_port_args)} -q {server} '{' && '.join(taskset_commands)}'")
+            pending.remove(server)
+        check_output_multiple(pin_commands)
+        if pending:
+            if time.time() > deadline:
+                raise Exception(f"Timed out waiting for {args.processes} worker processes to start on {pending}")
+            time.sleep(0.1)
+    return placement
+
+
+def record_cpu_placement(cpu_plans, worker_placement):
+    placement = {}
+    for server, plan in cpu_plans.items():
+        placement[server] = {
+            "pin_cpus": args.pin_cpus,
+            "worker_cpus": format_cpu_list(plan["worker_cpus"]),
+            "browser_cpus": format_cpu_list(plan["browser_cpus"]),
+            "workers": worker_placement.get(server, []),
+        }
+        logging.info(f"cpu placement on {server}: {placement[server]}")
+    if args.cpu_placement_file:
+        with open(args.cpu_placement_file, "w", encoding="utf-8") as f:
+            json.dump(placement, f, indent=4)
+
+
 def upload(server):
     files = args.extra_files.copy()
     if args.upload_plugins:
@@ -328,12 +589,19 @@ def upload(server):
         check_output(f"rsync -qrtl --exclude __pycache__ --exclude .mypy_cache {filestr} {server}:")
 
 
-def start_worker_process(server, port):
+def start_worker_process(server, port, cpu_plan=None):
     upload(server)
 
+    worker_taskset = []
+    browser_taskset = ""
+    if cpu_plan:
+        worker_taskset = ["taskset", "-c", format_cpu_list(cpu_plan["worker_cpus"])]
+        if cpu_plan["browser_cpus"]:
+            browser_taskset = f"taskset -c {format_cpu_list(cpu_plan['browser_cpus'])} "
+
     if args.selenium:
         check_output(f"ssh {' '.join(ssh_port_args)} -q {server} 'rm -rf /tmp/.com.google.Chrome.*' || true")
-        selenium_cmd = f"ssh {' '.join(ssh_port_args)} -q {server} 'pkill -f \"^java -jar selenium-server-4.\"; java -jar selenium-server-4.0.0.jar standalone > selenium.log 2>&1' &"
+        selenium_cmd = f"ssh {' '.join(ssh_port_args)} -q {server} 'pkill -f \"^java -jar selenium-server-4.\"; {browser_taskset}java -jar selenium-server-4.0.0.jar standalone > selenium.log 2>&1' &"
         logging.info(selenium_cmd)
         subprocess.Popen(
             selenium_cmd,
@@ -380,6 +648,10 @@ def start_worker_process(server, port):
     if args.test_env:
         extra_env.append("LOCUST_TEST_ENV=" + args.test_env)
 
+    # applies to the remote shell and is inherited by locust and all its forked worker processes
+    # (separate statement instead of && so that $! is still the pid of locust itself)
+    ulimit = ["ulimit", "-Sn", str(args.nofile_limit), "|| exit 1;"] if args.nofile_limit else []
+
     cmd = " ".join([
         "ssh",
         *ssh_port_args,
@@ -387,8 +659,10 @@ def start_worker_process(server, port):
         *port_forwarding_parameters,
         server,
         "'",
+        *ulimit,
         *extra_env,
         *nohup,
+        *worker_taskset,  # affinity is inherited by the processes locust forks
         "locust",
         "--worker",
         "--processes",
@@ -435,6 +709,12 @@ def main():
         parser.error(
             f"--processes-per-loadgen has been removed in favour of locusts native --processes parameter (you had it set to {args.processes_per_loadgen})"
         )
+    if args.pin_cpus and args.processes < 1:
+        parser.error(f"--pin-cpus requires an explicit number of --processes (you had it set to {args.processes})")
+    if args.reserve_browser_cores and not args.selenium:
+        parser.error("--reserve-browser-cores only applies to the selenium server, so it requires --selenium")
+    if args.cpu_placement_file and not (args.pin_cpus or args.reserve_browser_cores):
+        parser.error("--cpu-placement-file requires --pin-cpus or --reserve-browser-cores")
     if args.skip_plugins:
         parser.error(
             "--skip-plugins has been removed, the default is now NOT to upload plugins (but you can enable it with --upload-plugins)"
@@ -491,6 +771,17 @@ def main():
 
     server_list = get_available_servers_and_lock_them()
 
+    if args.preflight or args.nofile_limit:
+        all_limits = get_limits_multiple(server_list)
+        if args.nofile_limit:
+            check_nofile_limit(all_limits)
+        if args.preflight:
+            preflight(all_limits)
+
+    cpu_plans = {}
+    if args.pin_cpus or args.reserve_browser_cores:
+        cpu_plans = plan_cpu_placement_multiple(server_list)
+
     worker_procs = []
     extra_env = []
     start_time = datetime.now(timezone.utc)
@@ -526,6 +817,11 @@ def main():
         unrecognized_args.append("-L")
         unrecognized_args.append(args.loglevel)
 
+    # swarm only parses --users so that --preflight can size its checks, it must always be forwarded to master
+    if args.users:
+        unrecognized_args.append("--users")
+        unrecognized_args.append(str(args.users))
+
     if args.playwright:
         extra_env.append("LOCUST_PLAYWRIGHT=1")
 
@@ -557,7 +853,10 @@ def main():
     for server in server_list:
         # fail early if master has already terminated
         check_proc_running(master_proc)
-        worker_procs.extend(start_worker_process(server, port))
+        worker_procs.extend(start_worker_process(server, port, cpu_plans.get(server)))
+
+    if cpu_plans:
+        record_cpu_placement(cpu_plans, pin_worker_processes(cpu_plans, worker_procs))
 
     # check that worker procs didnt immediately terminate for some reason (like invalid parameters)
     try: